@@ -6,11 +6,19 @@ Recursively changes file and directory names to a standard format based on ID3 t
 import sys
 import os
 import re
+import errno
+import ctypes
 import argparse
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 from mutagen.flac import FLAC
 from mutagen.id3 import ID3
 from mutagen import MutagenError
 
+# compiled once here instead of re-looked-up in re's cache on every file
+_TRACK_RE = re.compile(r'(\d+)/')
+_TRAIL_DOT_RE = re.compile(r'(.*?)\.+$')
+
 
 def get_args():
     """
@@ -39,107 +47,214 @@ class FileTags:
         'orig_year': ['TORY', 'ORIGINALYEAR', 'TDOR', 'ORIGINALDATE']
     }
     FORBIDDEN = '<>:"/\\|?*\0'
+    _FORBIDDEN_TBL = str.maketrans('', '', FORBIDDEN)
+    # TAG_TYPES inverted so a descriptor resolves in one dict lookup.
+    # Each entry keeps its position in the TAG_TYPES list so set_tags can
+    # honor the same descriptor priority as scanning the lists in order;
+    # lowercase aliases cover Vorbis comments, whose keys iterate in
+    # lowercase even though membership tests ignore case
+    _DESC2TAG = {desc: (priority, tag)
+                 for tag, descs in TAG_TYPES.items()
+                 for priority, desc in enumerate(descs)}
+    _DESC2TAG.update({desc.lower(): pair
+                      for desc, pair in list(_DESC2TAG.items())})
+    # fixed slots: one FileTags is allocated per audio file, and slots
+    # avoid both the instance __dict__ and the old inner _tags dict
+    __slots__ = ('album', 'artist', 'album_artist', 'title',
+                 'track_num', 'disc_num', 'year', 'orig_year')
 
     def __init__(self):
-        self._tags = {
-            'album': '',
-            'artist': '',
-            'album_artist': '',
-            'title': '',
-            'track_num': '',
-            'disc_num': '',
-            'year': None,
-            'orig_year': None
-        }
+        self.album = ''
+        self.artist = ''
+        self.album_artist = ''
+        self.title = ''
+        self.track_num = ''
+        self.disc_num = ''
+        self.year = None
+        self.orig_year = None
 
     def __getitem__(self, key):
-        return self._tags[key]
+        return getattr(self, key)
 
     def set_tags(self, tags):
         """
         Gets relevant tag names out of mutagen tag data
         """
-        for tag_name in FileTags.TAG_TYPES:
-            for desc in FileTags.TAG_TYPES[tag_name]:
-                if desc in tags:
-                    if type(tags[desc]) is list:
-                        self._tags[tag_name] = tags[desc][0]
-                    else:
-                        self._tags[tag_name] = tags[desc].text[0]
-                    break
+        best = {}
+        for desc in tags:
+            entry = FileTags._DESC2TAG.get(desc)
+            if entry is None:
+                continue
+            priority, tag_name = entry
+            # keep the highest-priority descriptor seen for each tag, so
+            # the result doesn't depend on the tag dict's iteration order
+            if best.get(tag_name, len(FileTags.TAG_TYPES[tag_name])) <= priority:
+                continue
+            best[tag_name] = priority
+            if type(tags[desc]) is list:
+                value = tags[desc][0]
+            else:
+                value = tags[desc].text[0]
+            # clean each string as it is stored so no second scrub pass
+            # over the tags is needed; track/disc keep their '/' until
+            # the total-count suffix is split off below
+            if isinstance(value, str)\
+                    and tag_name not in ('track_num', 'disc_num'):
+                value = value.translate(FileTags._FORBIDDEN_TBL)
+            setattr(self, tag_name, value)
         # track number formatting
-        match = re.match(r'(\d+)/', self._tags['track_num'])
+        match = _TRACK_RE.match(self.track_num)
         if match is not None:
-            self._tags['track_num'] = match.group(1)
-        self._tags['track_num'] = self._tags['track_num'].zfill(2)
+            self.track_num = match.group(1)
+        self.track_num = self.track_num.translate(
+            FileTags._FORBIDDEN_TBL).zfill(2)
         # disc number formatting
-        match = re.match(r'(\d+)/', self._tags['disc_num'])
+        match = _TRACK_RE.match(self.disc_num)
         if match is not None:
-            self._tags['disc_num'] = match.group(1)
-        if self._tags['disc_num'] == '':
-            self._tags['disc_num'] = '1'
+            self.disc_num = match.group(1)
+        if self.disc_num == '':
+            self.disc_num = '1'
+        else:
+            self.disc_num = self.disc_num.translate(FileTags._FORBIDDEN_TBL)
         # date formatting
-        if not isinstance(self._tags['year'], str):
-            if self._tags['year'] is not None:
-                self._tags['year'] = str(self._tags['year'].year)
-        if not isinstance(self._tags['orig_year'], str):
-            if self._tags['orig_year'] is not None:
-                self._tags['orig_year'] = str(self._tags['orig_year'].year)
+        if not isinstance(self.year, str):
+            if self.year is not None:
+                self.year = str(self.year.year)
+        if not isinstance(self.orig_year, str):
+            if self.orig_year is not None:
+                self.orig_year = str(self.orig_year.year)
 
     def scrub(self):
         """
-        Removes forbidden filename characters from tag data
+        Removes forbidden filename characters from tag data. set_tags
+        already cleans as it stores; this remains for callers that set
+        tag values by other means
         """
-        for tag in self._tags:
-            clean = self._tags[tag]
+        for tag in FileTags.__slots__:
+            clean = getattr(self, tag)
             if not isinstance(clean, str):
                 continue
-            for forbidden_char in FileTags.FORBIDDEN:
-                clean = clean.replace(forbidden_char, '')
-            self._tags[tag] = clean
+            setattr(self, tag, clean.translate(FileTags._FORBIDDEN_TBL))
 
 
 YEAR_ENCLOSER = '[]'
 SEPARATOR = ' - '
-VALID_FILE_TYPES = ['.mp3', '.flac']
+VALID_FILE_EXTS = ('.mp3', '.flac')
+# maps each supported extension to its mutagen parser; add an entry here
+# (and in VALID_FILE_EXTS) to support a new format. ID3 skips the
+# v2.3<->v2.4 frame translation pass since TAG_TYPES lists the frame
+# names of both versions
+PARSERS = {
+    '.mp3': partial(ID3, translate=False),
+    '.flac': FLAC
+}
 
+# rename(2) on Linux silently replaces an existing target; renameat2 with
+# RENAME_NOREPLACE refuses atomically, with no separate existence check
+AT_FDCWD = -100
+RENAME_NOREPLACE = 1
+_LIBC = None
+if os.name == 'posix':
+    try:
+        _LIBC = ctypes.CDLL(None, use_errno=True)
+        _LIBC.renameat2
+    except (OSError, AttributeError):
+        _LIBC = None
 
-def rename_file(folder, file):
+
+def rename_noreplace(src, dst):
+    """
+    Renames src to dst, raising OSError instead of replacing an existing dst
+    """
+    if _LIBC is not None:
+        ret = _LIBC.renameat2(AT_FDCWD, os.fsencode(src),
+                              AT_FDCWD, os.fsencode(dst), RENAME_NOREPLACE)
+        if ret != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), src, None, dst)
+        return
+    if os.path.lexists(dst):
+        raise OSError(errno.EEXIST, os.strerror(errno.EEXIST), src, None, dst)
+    os.rename(src, dst)
+
+
+# tags live in the first stretch of the file; this is how much of each
+# file we ask the kernel to read ahead before parsing
+PREFETCH_BYTES = 64 * 1024
+
+
+def prefetch_file(folder, file):
+    """
+    Hints the kernel to read ahead the head of one file, so the tag
+    parse that follows hits warm page cache instead of paying a
+    synchronous disk stall on open
+    """
+    try:
+        fd = os.open(os.path.join(folder, file), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, PREFETCH_BYTES, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+
+def apply_renames(folder, renames):
     """
-    Renames a file based on its ID3 tags
+    Applies queued (old name, new name) renames within one folder. The
+    folder is opened once and renames go through its dirfd where the
+    platform allows, so the folder path is resolved once per folder
+    instead of twice per file
     """
-    full_path = folder + '/' + file
-    ext = re.search(r'.\w+$', file)
-    if ext is None:
+    if not renames:
         return
-    ext = ext.group()
-    folder_data = None
-    if ext in VALID_FILE_TYPES:
+    # os.rename stands proxy for os.replace here: CPython only registers
+    # os.rename in supports_dir_fd, but both share the same renameat-backed
+    # implementation, and os.replace itself never appears in the set
+    if os.rename in os.supports_dir_fd:
+        dirfd = os.open(folder, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
         try:
-            if ext == '.mp3':
-                tags = ID3(full_path)
-            elif ext == '.flac':
-                tags = FLAC(full_path)
-        except MutagenError:
-            return (None, '', 'missing')
-        file_tags = FileTags()
-        file_tags.set_tags(tags)
-        file_tags.scrub()
-        artist = file_tags['album_artist'] or file_tags['artist']
-        if artist == '' or file_tags['album'] == ''\
-                or file_tags['disc_num'] == '' or file_tags['title'] == '':
-            return (None, '', 'missing')
-        new_name = (artist + SEPARATOR + file_tags['album']
-                    + SEPARATOR + file_tags['disc_num'] + '-'
-                    + file_tags['track_num'] + SEPARATOR + file_tags['title'] + ext)
-        oldest_year = file_tags['orig_year']
-        if not oldest_year:
-            oldest_year = file_tags['year']
-        if file != new_name:
-            os.rename(full_path, folder + '/' + new_name)
-            folder_data = (oldest_year, file_tags['album'], 'renamed')
-        else:
-            folder_data = (oldest_year, file_tags['album'], 'unchanged')
+            for old_name, new_name in renames:
+                os.replace(old_name, new_name,
+                           src_dir_fd=dirfd, dst_dir_fd=dirfd)
+        finally:
+            os.close(dirfd)
+    else:
+        for old_name, new_name in renames:
+            os.replace(os.path.join(folder, old_name),
+                       os.path.join(folder, new_name))
+
+
+def rename_file(folder, file):
+    """
+    Works out a file's tag-based name. Returns (year, album, status,
+    new name), where new name is None unless the file needs renaming;
+    the caller applies the renames in one batch
+    """
+    ext = os.path.splitext(file)[1].lower()
+    if ext not in PARSERS:
+        return None
+    full_path = os.path.join(folder, file)
+    try:
+        tags = PARSERS[ext](full_path)
+    except MutagenError:
+        return (None, '', 'missing', None)
+    file_tags = FileTags()
+    file_tags.set_tags(tags)
+    artist = file_tags['album_artist'] or file_tags['artist']
+    if artist == '' or file_tags['album'] == ''\
+            or file_tags['disc_num'] == '' or file_tags['title'] == '':
+        return (None, '', 'missing', None)
+    new_name = (f"{artist}{SEPARATOR}{file_tags['album']}{SEPARATOR}"
+                f"{file_tags['disc_num']}-{file_tags['track_num']}"
+                f"{SEPARATOR}{file_tags['title']}{ext}")
+    oldest_year = file_tags['orig_year']
+    if not oldest_year:
+        oldest_year = file_tags['year']
+    if file != new_name:
+        folder_data = (oldest_year, file_tags['album'], 'renamed', new_name)
+    else:
+        folder_data = (oldest_year, file_tags['album'], 'unchanged', None)
     return folder_data
 
 
@@ -148,63 +263,87 @@ def scan_album_folder(folder, file_list):
     Renames all files in a folder. If all the files in the folder have the same Year and Album
     metadata, the folder itself will be renamed to the format "[YEAR] ALBUM"
     """
-    folder_data = []
+    # parallel lists rather than a list of tuples: the consistency check
+    # and status counts below then run as C-level set/count operations
+    years = []
+    albums = []
+    statuses = []
     folder_counts = {'found': 0, 'renamed': 0,
                      'unchanged': 0, 'missing': 0, 'folder_rename': ''}
-    if folder_data\
-            and len(folder_data[0]) == 3\
-            and folder_data[0][0]\
-            and folder_data[0][1]\
-            and all((x[0] == folder_data[0][0] and x[1] == folder_data[0][1]) for x in folder_data):
-        pass
-    for file in file_list:
-        folder_d = rename_file(folder, file)
-        if folder_d is not None:
-            folder_counts[folder_d[2]] += 1
-            folder_counts['found'] += 1
-            folder_data.append(folder_d)
-    if folder_data\
-            and len(folder_data[0]) == 3\
-            and folder_data[0][0]\
-            and folder_data[0][1]\
-            and all((x[0] == folder_data[0][0] and x[1] == folder_data[0][1]) for x in folder_data):
-        folder_name = YEAR_ENCLOSER[0] + \
-            folder_data[0][0] + YEAR_ENCLOSER[1] + ' ' + folder_data[0][1]
-        parent_path = re.sub(r'[^\\/]+[\\/]?$', '', folder)
-        if folder != '.' and folder != parent_path + folder_name:
-            counter = 2
-            base_dir = parent_path + folder_name
-            base_dir = re.search(r'(.*?)\.+$', base_dir)
-            if base_dir is None:
-                base_dir = parent_path + folder_name
-            else:
-                base_dir = base_dir.group(1)
+    # weed out non-audio files up front so only real work hits the pool
+    file_list = [f for f in file_list
+                 if os.path.splitext(f)[1].lower() in PARSERS]
+    if file_list:
+        # tag reads are I/O-bound, so overlap them across files; results are
+        # aggregated here in the main thread to keep folder_counts lock-free
+        pending_renames = []
+        with ThreadPoolExecutor(max_workers=min(32, len(file_list))) as executor:
+            # queue the readahead hints through the same pool, ahead of
+            # the parses, so issuing the hints overlaps too instead of
+            # being a serial pass of its own
+            if hasattr(os, 'posix_fadvise'):
+                for file in file_list:
+                    executor.submit(prefetch_file, folder, file)
+            for file, folder_d in zip(
+                    file_list,
+                    executor.map(lambda f: rename_file(folder, f), file_list)):
+                if folder_d is not None:
+                    years.append(folder_d[0])
+                    albums.append(folder_d[1])
+                    statuses.append(folder_d[2])
+                    if folder_d[3] is not None:
+                        pending_renames.append((file, folder_d[3]))
+        apply_renames(folder, pending_renames)
+    folder_counts['found'] = len(statuses)
+    for status in ('renamed', 'unchanged', 'missing'):
+        folder_counts[status] = statuses.count(status)
+    target_year = years[0] if years else None
+    target_album = albums[0] if albums else None
+    if target_year and target_album\
+            and len(set(years)) == 1 and len(set(albums)) == 1:
+        folder_name = (f'{YEAR_ENCLOSER[0]}{target_year}'
+                       f'{YEAR_ENCLOSER[1]} {target_album}')
+        parent_path = os.path.dirname(folder.rstrip('/\\'))
+        target_dir = os.path.join(parent_path, folder_name)
+        if folder != '.' and folder != target_dir:
+            base_dir = target_dir
+            match = _TRAIL_DOT_RE.search(base_dir)
+            if match is not None:
+                base_dir = match.group(1)
             base_dir = base_dir.strip()
-            try_dir = base_dir
-            while os.path.isdir(try_dir) and counter < 100:
-                if try_dir == folder:
-                    break
-                try_dir = base_dir + ' (' + str(counter) + ')'
-                counter += 1
-            if try_dir != folder:
-                folder_counts['folder_rename'] = (folder, try_dir)
+            # collision suffixes are worked out in memory by the caller's
+            # rename pass, so no stat probing happens here
+            if base_dir != folder:
+                folder_counts['folder_rename'] = (folder, base_dir)
     return folder_counts
 
 
-# how useful!
-# http://stackoverflow.com/questions/229186/os-walk-without-digging-into-directories-below
 def walklevel(some_dir, level=0):
     """
-    Walk directory to arbitrary depth
+    Walk directory to arbitrary depth. Built on os.scandir so entry types
+    come straight from the directory read, with no extra stat call per entry
     """
     some_dir = some_dir.rstrip(os.path.sep)
     assert os.path.isdir(some_dir)
-    num_sep = some_dir.count(os.path.sep)
-    for root_clip, dirs_clip, files_clip in os.walk(some_dir):
-        yield root_clip, dirs_clip, files_clip
-        num_sep_this = root_clip.count(os.path.sep)
-        if num_sep + level <= num_sep_this:
-            del dirs_clip[:]
+
+    def walk(path, depth):
+        dirs = []
+        files = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.name)
+                    else:
+                        files.append(entry.name)
+        except OSError:
+            return
+        yield path, dirs, files
+        if depth < level:
+            for name in dirs:
+                yield from walk(os.path.join(path, name), depth + 1)
+
+    yield from walk(some_dir, 0)
 
 
 def tags2name(recursion_level):
@@ -217,41 +356,69 @@ def tags2name(recursion_level):
     # settings output
     print()
     print('-=Settings=-')
-    print('Looking for file types: ' + ', '.join(VALID_FILE_TYPES))
+    print('Looking for file types: ' + ', '.join(VALID_FILE_EXTS))
     print()
     # directories output
     print()
     print('-=Directories=-')
-    for root, _, files in walklevel('.', recursion_level):
-        # give us something to look at while it's working
-        print('.', end='')
-        sys.stdout.flush()
-        total_dirs += 1
-        new_counts = scan_album_folder(root, files)
-        if new_counts['folder_rename']:
-            result['renamed_folders'].append(new_counts['folder_rename'])
-        result['found'] += new_counts['found']
-        result['renamed'] += new_counts['renamed']
-        result['unchanged'] += new_counts['unchanged']
-        result['missing'] += new_counts['missing']
-    print('\nDirectories searched: ' + str(total_dirs))
-    sys.stdout.flush()
-    # iterate through the folders that need to be renamed, bottom-up
-    for ren in reversed(result['renamed_folders']):
+    folders = [(root, files) for root, _, files in walklevel('.', recursion_level)]
+    total_dirs = len(folders)
+    # album folders are independent, so scan them in parallel processes
+    with ProcessPoolExecutor() as executor:
+        futures = [executor.submit(scan_album_folder, root, files)
+                   for root, files in folders]
+        dirs_done = 0
+        for future in as_completed(futures):
+            # give us something to look at while it's working, without
+            # paying a write syscall per directory
+            sys.stdout.write('.')
+            dirs_done += 1
+            if dirs_done % 64 == 0:
+                sys.stdout.flush()
+            new_counts = future.result()
+            result['found'] += new_counts['found']
+            result['renamed'] += new_counts['renamed']
+            result['unchanged'] += new_counts['unchanged']
+            result['missing'] += new_counts['missing']
+        # collect folder renames in walk order so the later rename pass
+        # can still work bottom-up
+        for future in futures:
+            new_counts = future.result()
+            if new_counts['folder_rename']:
+                result['renamed_folders'].append(new_counts['folder_rename'])
+    # the report is accumulated here and emitted in one write at the end,
+    # instead of a syscall-per-print trickle
+    lines = ['\nDirectories searched: ' + str(total_dirs)]
+    # iterate through the folders that need to be renamed, bottom-up;
+    # collisions get a ' (N)' suffix assigned from an in-memory set, with
+    # a single isdir check per final candidate
+    taken_dirs = set()
+    for src_dir, base_dir in reversed(result['renamed_folders']):
+        try_dir = base_dir
+        counter = 2
+        while try_dir != src_dir and counter < 100\
+                and (try_dir in taken_dirs or os.path.isdir(try_dir)):
+            try_dir = f'{base_dir} ({counter})'
+            counter += 1
+        taken_dirs.add(try_dir)
+        if try_dir == src_dir:
+            continue
         try:
-            os.rename(ren[0], ren[1])
-            print('RENAMED FOLDER: ' + ren[0] + ' -> ' + ren[1])
+            rename_noreplace(src_dir, try_dir)
+            lines.append('RENAMED FOLDER: ' + src_dir + ' -> ' + try_dir)
         except OSError:
-            print('ERROR: could not rename folder "' + ren[0] + '"')
-    print()
+            lines.append('ERROR: could not rename folder "' + src_dir + '"')
+    lines.append('')
     # files output
-    print()
-    print('-=Music files=-')
-    print('Found:        ' + str(result['found']))
-    print('---------------')
-    print('Changed:      ' + str(result['renamed']))
-    print('Unchanged:    ' + str(result['unchanged']))
-    print('Missing Tags: ' + str(result['missing']))
+    lines.append('')
+    lines.append('-=Music files=-')
+    lines.append('Found:        ' + str(result['found']))
+    lines.append('---------------')
+    lines.append('Changed:      ' + str(result['renamed']))
+    lines.append('Unchanged:    ' + str(result['unchanged']))
+    lines.append('Missing Tags: ' + str(result['missing']))
+    sys.stdout.write('\n'.join(lines) + '\n')
+    sys.stdout.flush()
 
 
 if __name__ == '__main__':